@@ -5,18 +5,23 @@
 
 
 import abc
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 from enum import Enum
-import json
+import hashlib
 import os
 import re
+import sqlite3
+import threading
 import time
-from typing import List, Set, Tuple, Dict
+from typing import Iterable, Iterator, List, Tuple, Dict
 
-from bs4 import BeautifulSoup, Tag  # , NavigableString
 import ebooklib
 from ebooklib import epub as epublib
 from google.cloud import translate
+import lxml.html
+from lxml.html import HtmlElement
 
 
 __all__ = ['EPUBTranslator', 'GoogleTranslator', 'MockTranslator',
@@ -54,12 +59,20 @@ class CannotTranslate(ValueError):
 
 class Translator:
     _CHUNK_SIZE = None  # bytes
+    _MAX_SEGMENTS = None  # strings per chunk, None for no limit
+    _sentences = re.compile(rb'[^.!?]*[.!?]+|[^.!?]+')  # ascii only, safe on utf-8 bytes
+    _QUERY_SIZE = 500  # sqlite host parameters per lookup
+    _MAX_WORKERS = 8
+    _MEMCACHE_SIZE = 1024
 
-    def __init__(self, *, cache_file: str = None, chunk_size=None,
+    def __init__(self, *, cache_file: str = None, chunk_size=None, max_workers=None, memcache_size=None,
                  source_language='en-US', target_language='zh-CN'):
         """
-        :param cache_file: specify False to turn off cache
+        :param cache_file: sqlite cache database, specify False to turn off cache
         :param chunk_size: specify maximum size to send to translate API
+        :param max_workers: specify maximum number of concurrent translate API calls
+        :param memcache_size: specify number of translations kept in memory in front of the cache database,
+            unbounded when cache is turned off
         :param source_language: source language
         :param target_language: target language
         """
@@ -67,77 +80,131 @@ class Translator:
             cache_file = (
                     'translator_' +
                     datetime.now().isoformat().replace(':', '-').replace('-', '_') +
-                    '.json'
+                    '.sqlite'
             )
         self._cache_file = cache_file
         self._chunk_size = chunk_size or self._CHUNK_SIZE
         if not self._chunk_size:
             raise ValueError('must specify chunk_size')
+        self._max_workers = max_workers or self._MAX_WORKERS
+        self._memcache_size = memcache_size or self._MEMCACHE_SIZE
         self._source_language = source_language
         self._target_language = target_language
-        self._save_cache(self._load_cache())  # test writability
-        self._cache = None
-
-    def _load_cache(self):
-        if self._cache_file:
-            if os.path.exists(self._cache_file):
-                with open(self._cache_file, mode='r') as f:
-                    cache = json.load(f)
-            else:
-                cache = {}
-        else:
-            if self._cache is None:
-                self._cache = {}
-            cache = self._cache
+        self._cache = OrderedDict()  # lru, most recently used last
+        self._cache_db = self._open_cache()  # fails early if not writable
+
+    def _open_cache(self):
+        if not self._cache_file:
+            return None
+        db = sqlite3.connect(self._cache_file)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')  # a lost last batch is only re-translated
+        with db:
+            db.execute('CREATE TABLE IF NOT EXISTS cache (key BLOB PRIMARY KEY, value TEXT)')
+        return db
+
+    def _cache_key(self, text: str) -> bytes:
+        key = '\0'.join((self._source_language, self._target_language, text))
+        return hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+
+    def _remember(self, trans: Dict[str, str]):
+        self._cache.update(trans)
+        if self._cache_db is not None:
+            while len(self._cache) > self._memcache_size:
+                self._cache.popitem(last=False)
+
+    def _load_cache(self, texts: Iterable[str]) -> Dict[str, str]:
+        cache = {}
+        for text in texts:
+            if text in self._cache:
+                self._cache.move_to_end(text)
+                cache[text] = self._cache[text]
+        if self._cache_db is not None:
+            keys = {self._cache_key(text): text for text in texts if text not in cache}
+            if keys:
+                loaded = {}
+                query = list(keys)
+                for i in range(0, len(query), self._QUERY_SIZE):
+                    batch = query[i:i + self._QUERY_SIZE]
+                    rows = self._cache_db.execute(
+                        f'SELECT key, value FROM cache WHERE key IN ({",".join("?" * len(batch))})', batch)
+                    for key, value in rows:
+                        loaded[keys[key]] = value
+                self._remember(loaded)
+                cache.update(loaded)
         return cache
 
-    def _save_cache(self, cache):
-        if self._cache_file:
-            with open(self._cache_file, mode='w') as f:
-                json.dump(cache, f)
+    def _save_cache(self, trans: Dict[str, str]):
+        self._remember(trans)
+        if self._cache_db is not None:
+            with self._cache_db:
+                self._cache_db.executemany(
+                    'INSERT OR REPLACE INTO cache (key, value) VALUES (?, ?)',
+                    ((self._cache_key(text), tran) for text, tran in trans.items()))
 
-    def translate_texts(self, texts: List[str]) -> (Dict[str, str], List[Exception]):
-        if isinstance(texts, str):
-            texts = [texts]
-        elif not isinstance(texts, list) or not all(isinstance(s, str) for s in texts):
-            raise ValueError('must specify string or a list of strings')
+    def translate_texts(self, texts: List[str], *, _unsafe: bool = False) -> (Dict[str, str], List[Exception]):
+        """
+        :param texts: string or list of strings to translate
+        :param _unsafe: caller guarantees a list of distinct, stripped, non-empty strings
+        """
+        if not _unsafe:
+            if isinstance(texts, str):
+                texts = [texts]
+            elif not isinstance(texts, list) or not all(isinstance(s, str) for s in texts):
+                raise ValueError('must specify string or a list of strings')
 
         errors = []
-        cache = self._load_cache()
-
-        distinct_texts = set()
-        for text in texts:
-            _text = text.strip()
-            if not _text:
-                cache[text] = ''
-                continue
-            if text not in cache:
-                distinct_texts.add(text)
-        if distinct_texts:
-            trans = []
-            chunks, _errors = self._chunk_texts(distinct_texts)
-            errors.extend(_errors)
-            for meta, chunk in chunks:
-                chunk_trans, _errors = self._translate_chunk(chunk)
+        if _unsafe:
+            cache = self._load_cache(texts)
+            distinct_texts = {text: None for text in texts if text not in cache}
+        else:
+            cache = self._load_cache(set(texts))
+            distinct_texts = {}
+            for text in texts:
+                _text = text.strip()
+                if not _text:
+                    cache[text] = ''
+                    continue
+                if text not in cache:
+                    distinct_texts[text] = None
+        if not distinct_texts:
+            # everything was cached, cache holds exactly the requested texts
+            return cache, errors
+
+        trans, failed = [], set()
+        chunks, _errors = self._chunk_texts(distinct_texts)
+        errors.extend(_errors)
+        with ThreadPoolExecutor(max_workers=self._max_workers) as executor:
+            futures = {executor.submit(self._translate_chunk, chunk): (meta, chunk) for meta, chunk in chunks}
+            for future in as_completed(futures):
+                meta, chunk = futures[future]
+                try:
+                    chunk_trans, _errors = future.result()
+                except Exception as e:
+                    # keep the other chunks, their translations are still saved
+                    chunk_trans, _errors = [], [CannotTranslate('cannot translate', text, e) for text in chunk]
                 if _errors:
+                    failed.update(text_id for text_id, _, _ in meta)
                     errors.extend(_errors)
                 else:
                     trans.extend(zip(meta, chunk_trans))
-            trans = self._unchunk_trans(trans)
-            if trans:
-                cache.update(trans)
-                self._save_cache(cache)
+        # a text split across chunks is incomplete unless every chunk succeeded, never cache it partially
+        trans = self._unchunk_trans([t for t in trans if t[0][0] not in failed])
+        if trans:
+            cache.update(trans)
+            self._save_cache(trans)
 
         return {text: cache.get(text) for text in texts}, errors
 
-    def _chunk_texts(self, texts: Set[str]) -> (List[Tuple[List[Tuple[int, int, str]], List[str]]], List[Exception]):
+    def _chunk_texts(self, texts: Iterable[str]) -> (List[Tuple[List[Tuple[int, int, str]], List[str]]], List[Exception]):
+        max_segments = self._MAX_SEGMENTS or float('inf')
         last_meta, last_chunk, last_chunk_size = [], [], 0
         chunks, errors = [(last_meta, last_chunk)], []
         for text_id, text in enumerate(texts):
-            size = len(text.encode('utf-8'))
+            size = len(text) if text.isascii() else len(text.encode('utf-8'))
             line_id = 0
             if size < self._chunk_size:
-                if last_chunk_size + size > self._chunk_size:
+                if last_chunk_size + size > self._chunk_size or len(last_chunk) >= max_segments:
                     last_meta, last_chunk, last_chunk_size = [(text_id, line_id, text)], [text.strip()], size
                     chunks.append((last_meta, last_chunk))
                 else:
@@ -145,36 +212,55 @@ class Translator:
                     last_chunk.append(text.strip())
                     last_chunk_size += size
             else:
-                lines = text.split('.')
-                if any(len(line.encode('utf-8')) > self._chunk_size for line in lines):
+                b_text = text.encode('utf-8')
+                spans = self._split_text(b_text)
+                if not spans:
                     errors.append(InvalidText('text too long', text))
                     continue
-                for line_id, line in enumerate(lines):
-                    line = line.strip()
+                for line_id, (start, end) in enumerate(spans):
+                    line = b_text[start:end].strip()
                     if not line:
                         continue
-                    size = len(line.encode('utf-8'))
-                    if last_chunk_size + size > self._chunk_size:
+                    size = len(line)
+                    line = line.decode('utf-8')
+                    if last_chunk_size + size > self._chunk_size or len(last_chunk) >= max_segments:
                         last_meta, last_chunk, last_chunk_size = [(text_id, line_id, text)], [line], size
                         chunks.append((last_meta, last_chunk))
                     else:
                         last_meta.append((text_id, line_id, text))
                         last_chunk.append(line)
                         last_chunk_size += size
-        return chunks, errors
+        # the first chunk stays empty if the first text was rejected
+        return [(meta, chunk) for meta, chunk in chunks if chunk], errors
+
+    def _split_text(self, text: bytes) -> List[Tuple[int, int]]:
+        """
+        pack whole sentences of utf-8 encoded text into (start, end) spans of at most chunk_size bytes,
+        returns an empty list if a single sentence is too long
+        """
+        spans, start, end = [], 0, 0
+        for m in self._sentences.finditer(text):
+            if m.end() - start > self._chunk_size:
+                if m.end() - end > self._chunk_size:
+                    return []
+                spans.append((start, end))
+                start = end
+            end = m.end()
+        spans.append((start, end))
+        return spans
 
     @staticmethod
     def _unchunk_trans(trans: List[Tuple[Tuple[int, int, str], str]]) -> Dict[str, str]:
-        trans = sorted(trans)
-        texts = {}
+        # chunks complete in any order, only lines of split texts need sorting
+        texts = defaultdict(list)
         for (text_id, line_id, orig), tran in trans:
-            if text_id not in texts:
-                texts[text_id] = orig, []
-            texts[text_id][1].append((line_id, tran))
+            texts[orig].append((line_id, tran))
         ret = {}
-        for orig, trans in texts.values():
-            trans = ' '.join([tran for line_id, tran in sorted(trans)])
-            ret[orig] = trans
+        for orig, lines in texts.items():
+            if len(lines) == 1:
+                ret[orig] = lines[0][1]
+            else:
+                ret[orig] = ' '.join(tran for line_id, tran in sorted(lines))
         return ret
 
     @abc.abstractmethod
@@ -187,22 +273,29 @@ class GoogleTranslator(Translator):
     simple class to wrap around google translate
     """
 
-    _CHUNK_SIZE = 1000
+    _CHUNK_SIZE = 28000  # v3 accepts ~30k codepoints per request, leave room for the envelope
+    _MAX_SEGMENTS = 1024  # v3 limit on contents per request
 
     def __init__(self, *, project_id='dad-translations', **kwargs):
         super().__init__(**kwargs)
         self._project_id = project_id
+        self._parent = f"projects/{self._project_id}/locations/global"
+        self._client = None
+        self._client_lock = threading.Lock()
+
+    def _get_client(self) -> translate.TranslationServiceClient:
+        # created on first use and shared by all workers
+        if self._client is None:
+            with self._client_lock:
+                if self._client is None:
+                    self._client = translate.TranslationServiceClient()
+        return self._client
 
     def _translate_chunk(self, chunk: List[str]) -> (List[str], List[Exception]):
-        client = translate.TranslationServiceClient()
-
-        location = "global"
-        parent = f"projects/{self._project_id}/locations/{location}"
-
         # https://cloud.google.com/translate/docs/supported-formats
-        response = client.translate_text(
+        response = self._get_client().translate_text(
             request={
-                "parent": parent,
+                "parent": self._parent,
                 "contents": chunk,
                 "mime_type": "text/plain",  # mime types: text/plain, text/html
                 "source_language_code": self._source_language,
@@ -230,7 +323,7 @@ class MockTranslator(Translator):
     def _translate_chunk(self, chunk: List[str]) -> (List[str], List[Exception]):
         if self._record:
             self.chunks.append(chunk)
-        return [''.join(('MOCKED: ', text)) for text in chunk], []
+        return ['MOCKED: ' + text for text in chunk], []
 
 
 # EPUB translator
@@ -251,7 +344,8 @@ class EPUBTranslator:
         ebooklib.ITEM_NAVIGATION,
         ebooklib.ITEM_STYLE,
     ]
-    _replace_newlines = re.compile('\n +')
+    _filename_table = str.maketrans({c: '_' for c in map(chr, range(128)) if not c.isalnum()})
+    _filename_chars = re.compile(r'\W')  # same as not isalnum(), '_' maps to itself
 
     def __init__(self, epub_file: str, translator: Translator,
                  html_tags: List[str] = None, ignored_item_types: List[str] = None):
@@ -270,7 +364,11 @@ class EPUBTranslator:
         if output_epub_file is None:
             output_epub_file = os.path.basename(self._epub_file).lower()
             assert output_epub_file.endswith('.epub')
-            output_epub_file = ''.join(c if c.isalnum() else '_' for c in output_epub_file[:-5])
+            output_epub_file = output_epub_file[:-5]
+            if output_epub_file.isascii():
+                output_epub_file = output_epub_file.translate(self._filename_table)
+            else:
+                output_epub_file = self._filename_chars.sub('_', output_epub_file)
             if translation_type == TranslationType.REPLACE:
                 output_epub_file += '.tran.epub'
             else:  # if translation_type == TranslationType.INLINE:
@@ -282,77 +380,73 @@ class EPUBTranslator:
             print(f'warning: overwriting existing file {output_epub_file}')
             print('sleeping for 15 seconds..')
             time.sleep(15)
-        ebook, contents = self._read_epub_file()
-        trans, errors = self._translator.translate_texts([r[0] for r in contents])
+        ebook, files = self._read_epub_file()
+        # rows never hold empty lines, duplicates are translated once
+        trans, errors = self._translator.translate_texts(
+            list(dict.fromkeys(line for _, _, rows in files.values() for line, _ in rows)), _unsafe=True)
         if errors:
             print(f'encountered {len(errors)} error(s):\n')
             for e in errors:
                 print(e)
             raise RuntimeError('cannot translate, see above')
-        files = self._build_files(contents, trans, translation_type)
-        for item in ebook.get_items():
-            if item.file_name in files:
-                soup = files[item.file_name]
-                item.set_content(str(soup).encode('utf-8'))
+        for item, content in self._build_files(files, trans, translation_type):
+            item.set_content(content)
         epublib.write_epub(output_epub_file, ebook)
         return output_epub_file
 
     def _read_epub_file(self, html_tags=None, ignored_item_types=None)\
-            -> (epublib.EpubBook, List[Tuple[str, Tag, epublib.EpubHtml]]):
+            -> (epublib.EpubBook, Dict[str, Tuple[epublib.EpubHtml, HtmlElement, List[Tuple[str, HtmlElement]]]]):
         if html_tags is None:
             html_tags = self._html_tags
         if ignored_item_types is None:
             ignored_item_types = self._ignored_item_types
         ebook = epublib.read_epub(self._epub_file)
-        contents = []
+        files = {}
         for item in ebook.get_items():
             if item.get_type() in ignored_item_types:
                 continue
-            # soup = BeautifulSoup(item.get_content().decode('utf-8'), 'html.parser')
-            soup = BeautifulSoup(item.get_content().decode('utf-8'))
-            for p in soup.find_all(html_tags):
-                line = self._replace_newlines.sub(' ', p.text.strip())
-                if not line:
-                    continue
-                contents.append((line, p, item))
-        return ebook, contents
+            content = item.get_content()
+            if not content.strip():
+                continue
+            tree = lxml.html.document_fromstring(content)
+            rows = list(self._iter_paragraphs(tree, html_tags))
+            if rows:  # documents without paragraphs are left untouched
+                files[item.file_name] = (item, tree, rows)
+        return ebook, files
 
-    def _build_files(self, contents: List[Tuple[str, Tag, epublib.EpubHtml]],
-                     trans: Dict[str, str], translation_type: TranslationType) -> Dict[str, BeautifulSoup]:
-        files = {}
-        soups = {}
-        for text, tag, item in contents:
-            if item.file_name not in files:
-                files[item.file_name] = {'rows': [], 'item': item}
-            files[item.file_name]['rows'].append((tag, text, trans.get(text)))
-        for k, f in files.items():
-            soup = BeautifulSoup(f['item'].get_content())
-            soups[k] = soup
-            tags = []
-            for p in soup.find_all(self._html_tags):
-                line = self._replace_newlines.sub(' ', p.text.strip())
-                if not line:
-                    continue
-                tags.append(p)
-            for t, r in zip(tags, f['rows']):
-                tag = r[0]
-                assert t == tag
-                if translation_type == TranslationType.REPLACE:
-                    t.string = r[-1]
-                    # if t.string:
-                    #     t.string = r[-1]
-                    # else:
-                    #     for c in t.children:
-                    #         if isinstance(c, NavigableString):
-                    #             c.replace_with(r[-1])
-                    #             break
-                    #     else:
-                    #         t.string = r[-1]
-                else:
-                    new_tag = soup.new_tag(name=tag.name, **tag.attrs)
-                    new_tag.append(r[-1])
-                    t.insert_after(new_tag)
-        return soups
+    @staticmethod
+    def _iter_paragraphs(tree: HtmlElement, html_tags: List[str]) -> Iterator[Tuple[str, HtmlElement]]:
+        # single pass in document order, tag filtering happens inside lxml
+        for p in tree.iter(*html_tags):
+            line = ' '.join(''.join(p.itertext()).split())
+            if line:
+                yield line, p
+
+    def _build_files(self, files: Dict[str, Tuple[epublib.EpubHtml, HtmlElement, List[Tuple[str, HtmlElement]]]],
+                     trans: Dict[str, str], translation_type: TranslationType) \
+            -> Iterator[Tuple[epublib.EpubHtml, bytes]]:
+        """
+        apply translations one file at a time and yield each item with its new content,
+        each file is popped from files so nothing references its tree once it is serialized
+        """
+        while files:
+            yield self._build_file(files.pop(next(iter(files))), trans, translation_type)
+
+    @staticmethod
+    def _build_file(file: Tuple[epublib.EpubHtml, HtmlElement, List[Tuple[str, HtmlElement]]],
+                    trans: Dict[str, str], translation_type: TranslationType) -> Tuple[epublib.EpubHtml, bytes]:
+        item, tree, rows = file
+        for text, tag in rows:
+            tran = trans.get(text)
+            if translation_type == TranslationType.REPLACE:
+                del tag[:]
+                tag.text = tran
+            else:
+                new_tag = tag.makeelement(tag.tag, tag.attrib)
+                new_tag.text = tran
+                new_tag.tail, tag.tail = tag.tail, None
+                tag.addnext(new_tag)
+        return item, lxml.html.tostring(tree, encoding='utf-8')
 
 
 if __name__ == '__main__':